@@ -2,10 +2,12 @@ import streamlit as st
 import json
 import os
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import requests
 from urllib.parse import urlencode
 import secrets
+import uuid
 import base64
 
 # --- Configuración de la página de Streamlit ---
@@ -200,6 +202,7 @@ def handle_oauth_callback():
                 st.session_state.user_info = user_info
                 st.session_state.access_token = token_data['access_token']
                 st.session_state.user_id = user_info.get('id', user_info.get('email')) # Usa el ID de Google o email como ID de usuario
+                start_prefetch(st.session_state.user_id) # Empieza a cargar los datos del usuario en segundo plano
                 st.query_params.clear() # Limpia los parámetros de la URL
                 st.rerun() # Vuelve a ejecutar la aplicación para reflejar el estado de autenticación
             else:
@@ -249,28 +252,107 @@ CATEGORIES = {
 }
 
 # --- Funciones de persistencia (Opcional, la app es transitoria por defecto) ---
-# Si se desea persistencia, se debe descomentar y adaptar estas funciones
-# y llamar a `load_data` al inicio y `save_data` al guardar.
-
-# def get_user_data_path(user_id, filename):
-#     """Genera la ruta del archivo de datos para un usuario específico."""
-#     data_dir = os.path.join("data", user_id)
-#     os.makedirs(data_dir, exist_ok=True)
-#     return os.path.join(data_dir, filename)
-
-# def load_data(user_id, filename, default_value):
-#     """Carga datos de un archivo JSON específico del usuario."""
-#     path = get_user_data_path(user_id, filename)
-#     if os.path.exists(path):
-#         with open(path, 'r', encoding='utf-8') as f:
-#             return json.load(f)
-#     return default_value
-
-# def save_data(user_id, data, filename):
-#     """Guarda datos en un archivo JSON específico del usuario."""
-#     path = get_user_data_path(user_id, filename)
-#     with open(path, 'w', encoding='utf-8') as f:
-#         json.dump(data, f, ensure_ascii=False, indent=4)
+# La carga se hace en segundo plano con `start_prefetch` al conocer el `user_id`.
+# Si se desea persistencia completa, se deben descomentar las llamadas a `save_data`.
+
+def get_user_data_path(user_id, filename):
+    """Genera la ruta del archivo de datos para un usuario específico."""
+    return os.path.join("data", user_id, filename)
+
+def load_data(user_id, filename, default_value):
+    """Carga datos de un archivo JSON específico del usuario."""
+    path = get_user_data_path(user_id, filename)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return default_value
+
+def save_data(user_id, data, filename):
+    """Guarda datos en un archivo JSON específico del usuario."""
+    path = get_user_data_path(user_id, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+
+# --- Índice de productos por ID ---
+# Evita recorrer la lista maestra para localizar un producto a partir de su ID.
+# No accede a st.session_state para poder ejecutarse en hilos de fondo.
+
+def build_products_by_id(master_list):
+    """Construye el índice {'item_id': producto} de la lista maestra."""
+    products_by_id = {}
+    for product in master_list:
+        products_by_id.setdefault(product['id'], product) # Igual que buscar el primero en la lista
+    return products_by_id
+
+# --- Carga de datos en segundo plano ---
+
+def load_catalog(user_id):
+    """Carga la lista maestra y construye su índice por ID."""
+    master_list = load_data(user_id, 'lista_maestra.json', [])
+    return master_list, build_products_by_id(master_list)
+
+def start_prefetch(user_id):
+    """Lanza en un pool de hilos la carga del catálogo, su índice y el historial."""
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+    st.session_state.prefetch = {
+        'executor': executor,
+        'catalog': executor.submit(load_catalog, user_id),
+        'history': executor.submit(load_data, user_id, 'selecciones_semanales.json', []),
+    }
+
+def stop_prefetch():
+    """Cancela la carga en segundo plano pendiente y libera su pool de hilos."""
+    prefetch = st.session_state.get('prefetch')
+    if prefetch is not None:
+        prefetch['executor'].shutdown(wait=False, cancel_futures=True)
+        st.session_state.prefetch = None
+
+def prefetch_pending():
+    """Indica si quedan datos por cargar en segundo plano."""
+    return st.session_state.prefetch is not None
+
+def apply_prefetched_data():
+    """Incorpora al estado de la sesión los datos que ya se hayan cargado.
+
+    El catálogo se aplica junto con su índice, para que las ediciones
+    posteriores lo mantengan sincronizado de forma incremental.
+    """
+    prefetch = st.session_state.prefetch
+    if prefetch is None:
+        return
+
+    if not st.session_state.catalog_loaded and prefetch['catalog'].done():
+        try:
+            st.session_state.master_list, st.session_state.products_by_id = prefetch['catalog'].result()
+        except Exception as e:
+            st.error(f"Error al cargar la lista maestra: {e}")
+            st.session_state.master_list = []
+            st.session_state.products_by_id = {}
+        st.session_state.catalog_loaded = True
+        rebuild_selection_counters()
+
+    if not st.session_state.history_loaded and prefetch['history'].done():
+        try:
+            st.session_state.weekly_selections = prefetch['history'].result()
+        except Exception as e:
+            st.error(f"Error al cargar el historial: {e}")
+            st.session_state.weekly_selections = []
+        st.session_state.history_loaded = True
+
+    if st.session_state.catalog_loaded and st.session_state.history_loaded:
+        stop_prefetch()
+
+@st.fragment(run_every=0.5)
+def prefetch_watcher():
+    """Relanza la aplicación en cuanto termina alguna carga en segundo plano."""
+    prefetch = st.session_state.prefetch
+    if prefetch is None:
+        return
+    catalog_ready = prefetch['catalog'].done()
+    history_ready = prefetch['history'].done()
+    if (catalog_ready and not st.session_state.catalog_loaded) or (history_ready and not st.session_state.history_loaded):
+        st.rerun(scope="app")
 
 # --- Inicialización del estado de la sesión ---
 def initialize_session_state():
@@ -283,13 +365,16 @@ def initialize_session_state():
         st.session_state.access_token = None
     if 'user_id' not in st.session_state:
         st.session_state.user_id = None # Se establecerá después de la autenticación
+    if 'prefetch' not in st.session_state:
+        st.session_state.prefetch = None # Futures de la carga en segundo plano (ver start_prefetch)
 
     # Datos de la aplicación, transitorios por sesión
     if 'master_list' not in st.session_state:
         st.session_state.master_list = [] # [{'id': 'uuid', 'name': 'Leche', 'category': 'Lácteos y Huevos'}]
-        # Si se desea persistencia:
-        # if st.session_state.user_id:
-        #     st.session_state.master_list = load_data(st.session_state.user_id, 'lista_maestra.json', [])
+    if 'catalog_loaded' not in st.session_state:
+        st.session_state.catalog_loaded = False # Se marca al aplicar la carga en segundo plano
+    if 'products_by_id' not in st.session_state:
+        st.session_state.products_by_id = {} # {'item_id': producto} para búsquedas por ID
 
     if 'current_selection' not in st.session_state:
         st.session_state.current_selection = {} # {'item_id': True/False} para checkboxes
@@ -298,9 +383,8 @@ def initialize_session_state():
 
     if 'weekly_selections' not in st.session_state:
         st.session_state.weekly_selections = [] # [{'date': 'YYYY-MM-DD HH:MM', 'items': [{'id': 'uuid', 'name': 'Leche', 'category': 'Lácteos', 'quantity': 2}]}]
-        # Si se desea persistencia:
-        # if st.session_state.user_id:
-        #     st.session_state.weekly_selections = load_data(st.session_state.user_id, 'selecciones_semanales.json', [])
+    if 'history_loaded' not in st.session_state:
+        st.session_state.history_loaded = False # Se marca al aplicar la carga en segundo plano
 
     if 'current_date' not in st.session_state:
         st.session_state.current_date = datetime.now().date()
@@ -313,6 +397,68 @@ def initialize_session_state():
     if 'filter_status' not in st.session_state:
         st.session_state.filter_status = "Todos"
 
+    # Contadores de selección, mantenidos de forma incremental en cada cambio
+    if 'selected_count' not in st.session_state:
+        st.session_state.selected_count = 0 # Total de productos seleccionados
+    if 'selected_by_category' not in st.session_state:
+        st.session_state.selected_by_category = {} # {'categoria': seleccionados}
+    if 'category_totals' not in st.session_state:
+        st.session_state.category_totals = {} # {'categoria': productos en la lista maestra}
+
+# --- Funciones de contadores de selección ---
+
+def rebuild_selection_counters():
+    """Recalcula desde cero los contadores de selección (solo tras cambios masivos)."""
+    category_totals = {}
+    selected_by_category = {}
+    selected_count = 0
+    for product in st.session_state.master_list:
+        category = product['category']
+        category_totals[category] = category_totals.get(category, 0) + 1
+        if st.session_state.current_selection.get(product['id'], False):
+            selected_by_category[category] = selected_by_category.get(category, 0) + 1
+            selected_count += 1
+    st.session_state.category_totals = category_totals
+    st.session_state.selected_by_category = selected_by_category
+    st.session_state.selected_count = selected_count
+
+def reset_selection_widgets():
+    """Elimina el estado de los checkboxes y cantidades para que se regeneren desde `value=`.
+
+    Necesario al reemplazar en bloque `current_selection` o `product_quantities`,
+    ya que los widgets con estado ignoran los cambios de `value=`.
+    """
+    for key in list(st.session_state.keys()):
+        if key.startswith("select_") or key.startswith("qty_"):
+            del st.session_state[key]
+
+def adjust_selection_counters(category, delta):
+    """Suma `delta` a los contadores de seleccionados global y de la categoría."""
+    st.session_state.selected_count += delta
+    selected_by_category = st.session_state.selected_by_category
+    selected_by_category[category] = selected_by_category.get(category, 0) + delta
+
+def adjust_category_total(category, delta):
+    """Suma `delta` al total de productos de una categoría."""
+    category_totals = st.session_state.category_totals
+    category_totals[category] = category_totals.get(category, 0) + delta
+
+def toggle_product_selection(product_id, category):
+    """Callback del checkbox: actualiza la selección y los contadores en O(1)."""
+    is_selected = st.session_state[f"select_{product_id}"]
+    was_selected = st.session_state.current_selection.get(product_id, False)
+    st.session_state.current_selection[product_id] = is_selected
+    if is_selected and not was_selected:
+        adjust_selection_counters(category, 1)
+    elif was_selected and not is_selected:
+        adjust_selection_counters(category, -1)
+        # Asegurarse de que la cantidad se resetee si se deselecciona
+        st.session_state.product_quantities.pop(product_id, None)
+
+def update_product_quantity(product_id):
+    """Callback del input de cantidad: guarda la cantidad del producto."""
+    st.session_state.product_quantities[product_id] = st.session_state[f"qty_{product_id}"]
+
 # --- Funciones de gestión de la lista maestra ---
 
 def add_product():
@@ -325,12 +471,15 @@ def add_product():
         if any(p['name'].lower() == product_name.lower() and p['category'] == product_category for p in st.session_state.master_list):
             st.warning(f"'{product_name}' ya existe en la categoría '{product_category}'.")
         else:
-            new_id = str(len(st.session_state.master_list) + 1) # ID simple, se podría usar UUID
-            st.session_state.master_list.append({
+            new_id = str(uuid.uuid4()) # ID único, no se repite tras eliminar productos
+            new_product = {
                 'id': new_id,
                 'name': product_name,
                 'category': product_category
-            })
+            }
+            st.session_state.master_list.append(new_product)
+            st.session_state.products_by_id[new_id] = new_product
+            adjust_category_total(product_category, 1)
             st.session_state.new_product_name = "" # Limpiar el input
             st.success(f"'{product_name}' añadido a la lista maestra.")
             # Si se desea persistencia:
@@ -340,7 +489,18 @@ def add_product():
 
 def delete_product(product_id):
     """Elimina un producto de la lista maestra."""
-    st.session_state.master_list = [p for p in st.session_state.master_list if p['id'] != product_id]
+    is_selected = st.session_state.current_selection.get(product_id, False)
+    remaining_products = []
+    for product in st.session_state.master_list:
+        if product['id'] != product_id:
+            remaining_products.append(product)
+            continue
+        # Ajustar los contadores por cada producto eliminado (listas antiguas pueden repetir IDs)
+        adjust_category_total(product['category'], -1)
+        if is_selected:
+            adjust_selection_counters(product['category'], -1)
+    st.session_state.master_list = remaining_products
+    st.session_state.products_by_id.pop(product_id, None)
     st.session_state.current_selection.pop(product_id, None) # Eliminar de la selección actual si existe
     st.session_state.product_quantities.pop(product_id, None) # Eliminar la cantidad si existe
     st.success("Producto eliminado.")
@@ -352,6 +512,9 @@ def clear_master_list():
     st.session_state.master_list = []
     st.session_state.current_selection = {}
     st.session_state.product_quantities = {}
+    st.session_state.products_by_id = {}
+    reset_selection_widgets()
+    rebuild_selection_counters()
     st.success("Lista maestra limpiada.")
     # Si se desea persistencia:
     # save_data(st.session_state.user_id, st.session_state.master_list, 'lista_maestra.json')
@@ -360,6 +523,12 @@ def update_product(product_id, new_name, new_category):
     """Actualiza un producto existente en la lista maestra."""
     for product in st.session_state.master_list:
         if product['id'] == product_id:
+            if product['category'] != new_category:
+                adjust_category_total(product['category'], -1)
+                adjust_category_total(new_category, 1)
+                if st.session_state.current_selection.get(product_id, False):
+                    adjust_selection_counters(product['category'], -1)
+                    adjust_selection_counters(new_category, 1)
             product['name'] = new_name.strip()
             product['category'] = new_category
             st.success(f"Producto '{new_name}' actualizado.")
@@ -375,7 +544,7 @@ def save_current_selection():
     for item_id, is_selected in st.session_state.current_selection.items():
         if is_selected:
             # Encuentra el producto en la lista maestra
-            product = next((p for p in st.session_state.master_list if p['id'] == item_id), None)
+            product = st.session_state.products_by_id.get(item_id)
             if product:
                 quantity = st.session_state.product_quantities.get(item_id, 1) # Cantidad por defecto 1
                 selected_items.append({
@@ -422,6 +591,8 @@ def reuse_selection(selection_index):
         historical_selection = st.session_state.weekly_selections[selection_index]
         st.session_state.current_selection = {item['id']: True for item in historical_selection['items']}
         st.session_state.product_quantities = {item['id']: item['quantity'] for item in historical_selection['items']}
+        reset_selection_widgets()
+        rebuild_selection_counters()
         st.success(f"Lista del {historical_selection['date']} cargada para edición.")
     else:
         st.error("Índice de selección no válido.")
@@ -441,6 +612,10 @@ def delete_weekly_selection(selection_index):
 
 def main_app():
     """Función principal de la aplicación una vez autenticado el usuario."""
+    if st.session_state.prefetch is None and not (st.session_state.catalog_loaded and st.session_state.history_loaded):
+        start_prefetch(st.session_state.user_id)
+    apply_prefetched_data()
+
     user_name = st.session_state.user_info.get('name', 'Usuario')
     user_email = st.session_state.user_info.get('email', '')
     user_id_display = st.session_state.user_id # Mostrar el ID completo del usuario
@@ -451,9 +626,13 @@ def main_app():
     st.sidebar.markdown(f"🆔 ID de Usuario: `{user_id_display}`") # Mostrar ID completo
 
     if st.sidebar.button("Cerrar Sesión", key="logout_button"):
+        stop_prefetch() # No dejar hilos de carga huérfanos
         st.session_state.clear() # Limpia todo el estado de la sesión
         st.rerun()
 
+    if prefetch_pending():
+        prefetch_watcher()
+
     st.title("🛒 Gestor de Compras del Supermercado")
 
     tab1, tab2, tab3 = st.tabs(["📋 Lista Maestra", "📝 Selección Semanal", "⏳ Historial de Selecciones"])
@@ -470,11 +649,13 @@ def main_app():
             with col_cat:
                 new_product_category = st.selectbox("Categoría", options=list(CATEGORIES.keys()), key="new_product_category")
             
-            st.form_submit_button("➕ Añadir Producto", on_click=add_product)
+            st.form_submit_button("➕ Añadir Producto", on_click=add_product, disabled=not st.session_state.catalog_loaded)
 
         st.subheader("Productos en tu Lista Maestra")
 
-        if not st.session_state.master_list:
+        if not st.session_state.catalog_loaded:
+            st.info("⏳ Cargando tu lista maestra...")
+        elif not st.session_state.master_list:
             st.info("No hay productos en tu lista maestra. ¡Añade algunos!")
         else:
             # Mostrar la lista maestra en un DataFrame editable
@@ -514,6 +695,9 @@ def main_app():
                         'category': updated_category
                     })
                 st.session_state.master_list = updated_master_list
+                st.session_state.products_by_id = build_products_by_id(updated_master_list)
+                reset_selection_widgets()
+                rebuild_selection_counters()
                 st.success("Cambios en la lista maestra guardados.")
                 # Si se desea persistencia:
                 # save_data(st.session_state.user_id, st.session_state.master_list, 'lista_maestra.json')
@@ -571,15 +755,22 @@ def main_app():
                 p for p in filtered_master_list
                 if p['category'] == st.session_state.filter_category
             ]
+        # El progreso se calcula sobre los productos filtrados por nombre y categoría
+        progress_master_list = filtered_master_list
+        # Aplicar filtro por estado antes de renderizar (current_selection ya está
+        # actualizado por los callbacks de los checkboxes)
+        if st.session_state.filter_status == "Seleccionados":
+            filtered_master_list = [p for p in filtered_master_list if st.session_state.current_selection.get(p['id'], False)]
+        elif st.session_state.filter_status == "No Seleccionados":
+            filtered_master_list = [p for p in filtered_master_list if not st.session_state.current_selection.get(p['id'], False)]
 
         # Mostrar productos para selección
         st.subheader("Productos Disponibles")
-        if not filtered_master_list:
+        if not st.session_state.catalog_loaded:
+            st.info("⏳ Cargando productos...")
+        elif not filtered_master_list:
             st.info("No hay productos que coincidan con los filtros o la lista maestra está vacía.")
         else:
-            total_products = len(filtered_master_list)
-            selected_count = 0
-
             # Usar columnas para una mejor disposición de los elementos
             cols = st.columns(4) # Ajusta el número de columnas según el tamaño de la pantalla
 
@@ -589,49 +780,51 @@ def main_app():
                     is_selected = st.checkbox(
                         f"{CATEGORIES.get(product['category'], {}).get('emoji', '')} {product['name']}",
                         value=st.session_state.current_selection.get(product['id'], False),
-                        key=f"select_{product['id']}"
+                        key=f"select_{product['id']}",
+                        on_change=toggle_product_selection,
+                        args=(product['id'], product['category'])
                     )
-                    st.session_state.current_selection[product['id']] = is_selected
 
                     # Mostrar input de cantidad solo si está seleccionado
                     if is_selected:
-                        selected_count += 1
                         current_quantity = st.session_state.product_quantities.get(product['id'], 1)
-                        quantity = st.number_input(
+                        st.number_input(
                             "Cantidad",
                             min_value=1,
                             value=int(current_quantity), # Asegurarse de que el valor inicial sea un entero
-                            key=f"qty_{product['id']}"
+                            key=f"qty_{product['id']}",
+                            on_change=update_product_quantity,
+                            args=(product['id'],)
                         )
-                        st.session_state.product_quantities[product['id']] = quantity
-                    else:
-                        # Asegurarse de que la cantidad se resetee si se deselecciona
-                        st.session_state.product_quantities.pop(product['id'], None)
-
-            # Aplicar filtro por estado (después de que los checkboxes hayan actualizado current_selection)
-            if st.session_state.filter_status == "Seleccionados":
-                filtered_master_list = [p for p in filtered_master_list if st.session_state.current_selection.get(p['id'], False)]
-            elif st.session_state.filter_status == "No Seleccionados":
-                filtered_master_list = [p for p in filtered_master_list if not st.session_state.current_selection.get(p['id'], False)]
-
-            # Recalcular el progreso después de aplicar el filtro de estado
-            if total_products > 0:
-                progress_percent = (selected_count / total_products) * 100
-                st.markdown(f"**Progreso de Selección:** {selected_count} de {total_products} productos seleccionados")
-                st.progress(progress_percent / 100)
-            else:
-                st.info("No hay productos en la lista maestra para seleccionar.")
 
+        # Sin filtro por nombre, los contadores incrementales dan el progreso sin recorrer la lista
+        if st.session_state.filter_name:
+            total_products = len(progress_master_list)
+            selected_count = sum(1 for p in progress_master_list if st.session_state.current_selection.get(p['id'], False))
+        elif st.session_state.filter_category != "Todas":
+            selected_count = st.session_state.selected_by_category.get(st.session_state.filter_category, 0)
+            total_products = st.session_state.category_totals.get(st.session_state.filter_category, 0)
+        else:
+            selected_count = st.session_state.selected_count
+            total_products = len(st.session_state.master_list)
+
+        if total_products > 0:
+            progress_percent = (selected_count / total_products) * 100
+            st.markdown(f"**Progreso de Selección:** {selected_count} de {total_products} productos seleccionados")
+            st.progress(progress_percent / 100)
+
+        if st.session_state.master_list:
             st.markdown("---")
             col_save, col_export = st.columns(2)
             with col_save:
-                if st.button("💾 Guardar Selección Actual", key="save_current_selection_button"):
+                # Se espera al historial para que su carga no sobrescriba la lista guardada
+                if st.button("💾 Guardar Selección Actual", key="save_current_selection_button", disabled=not st.session_state.history_loaded):
                     save_current_selection()
             with col_export:
                 current_selected_items_for_export = []
                 for item_id, is_selected in st.session_state.current_selection.items():
                     if is_selected:
-                        product = next((p for p in st.session_state.master_list if p['id'] == item_id), None)
+                        product = st.session_state.products_by_id.get(item_id)
                         if product:
                             current_selected_items_for_export.append({
                                 'id': product['id'],
@@ -653,7 +846,9 @@ def main_app():
         st.header("Historial de Selecciones")
         st.markdown("Revisa, reutiliza o elimina tus listas de compras guardadas.")
 
-        if not st.session_state.weekly_selections:
+        if not st.session_state.history_loaded:
+            st.info("⏳ Cargando historial de selecciones...")
+        elif not st.session_state.weekly_selections:
             st.info("No hay listas de compras guardadas en el historial.")
         else:
             for i, selection_entry in enumerate(st.session_state.weekly_selections):